@@ -1,22 +1,209 @@
+import io
 import os
-import requests
+import shutil
+import urllib3
 import cv2
 import numpy as np
 from pathlib import Path
+from PIL import Image
 import json
-import random
 from urllib.parse import urlparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Shared connection pool so sample downloads from the same host reuse connections
+_HTTP = urllib3.PoolManager(maxsize=16, retries=urllib3.Retry(3))
+
+# Optional SIMD JPEG codec for the augmentation loop, falls back to OpenCV
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # PyTurboJPEG or libturbojpeg not installed
+    _turbo_jpeg = None
+
+# EXIF tag holding the camera orientation of a photo
+_EXIF_ORIENTATION = 0x0112
+
+def _read_jpeg(path):
+    """Decode a JPEG to a BGR image, returning None if it cannot be read"""
+    if _turbo_jpeg is not None:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            
+            # TurboJPEG ignores EXIF orientation while cv2.imread applies it, so
+            # rotated photos go through OpenCV to stay aligned with their labels
+            with Image.open(io.BytesIO(data)) as img:
+                orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+            if orientation == 1:
+                return _turbo_jpeg.decode(data, pixel_format=TJPF_BGR)
+        except Exception:
+            pass
+    return cv2.imread(str(path))
+
+def _write_jpeg(path, image):
+    """Encode a BGR image as JPEG"""
+    if _turbo_jpeg is not None:
+        with open(path, 'wb') as f:
+            f.write(_turbo_jpeg.encode(image, quality=95, pixel_format=TJPF_BGR))
+    else:
+        cv2.imwrite(str(path), image)
+
+def _scan_label_lines(label_file, lines):
+    """Check label lines one at a time, reporting issues with file line numbers"""
+    issues = []
+    for line_num, line in enumerate(lines, 1):
+        parts = line.strip().split()
+        if len(parts) != 5:
+            issues.append(f"{label_file}:{line_num} - Invalid format")
+            continue
+        
+        try:
+            class_id, cx, cy, w, h = map(float, parts)
+        except ValueError as e:
+            issues.append(f"{label_file}:{line_num} - Error reading file: {e}")
+            continue
+        
+        # Check if values are in valid range
+        if not (0 <= cx <= 1 and 0 <= cy <= 1 and 0 <= w <= 1 and 0 <= h <= 1):
+            issues.append(f"{label_file}:{line_num} - Values out of range")
+    
+    return issues
+
+def _validate_one(label_path, image_dir):
+    """Validate a single YOLO label file, returning a list of issues"""
+    issues = []
+    label_file = Path(label_path)
+    image_dir = Path(image_dir)
+    
+    # Check if corresponding image exists
+    img_name = label_file.stem + '.jpg'
+    if not (image_dir / img_name).exists():
+        img_name = label_file.stem + '.png'
+        if not (image_dir / img_name).exists():
+            issues.append(f"Missing image for {label_file}")
+            return issues
+    
+    # Validate annotation format
+    try:
+        with open(label_file, 'r') as f:
+            lines = f.readlines()
+    except Exception as e:
+        issues.append(f"{label_file} - Error reading file: {e}")
+        return issues
+    
+    if not lines:
+        return issues
+    
+    # Parse the whole file in one NumPy call; blank or malformed lines make
+    # loadtxt fail or skip rows, so those files fall back to a per-line scan
+    try:
+        annotations = np.loadtxt(lines, ndmin=2, comments=None)
+    except ValueError:
+        annotations = None
+    
+    if annotations is None or annotations.shape != (len(lines), 5):
+        return _scan_label_lines(label_file, lines)
+    
+    # Check if values are in valid range
+    coords = annotations[:, 1:5]
+    out_of_range = ~((coords >= 0) & (coords <= 1)).all(axis=1)
+    for row in np.flatnonzero(out_of_range):
+        issues.append(f"{label_file}:{row + 1} - Values out of range")
+    
+    return issues
+
+def _augment(image, rng, noise_buf=None):
+    """Apply random brightness, rotation and noise to image
+    
+    Returns the augmented image and the noise buffer so it can be reused
+    """
+    h, w = image.shape[:2]
+    
+    brightness = rng.uniform(0.7, 1.3)
+    angle = rng.uniform(-10, 10)
+    
+    # Random rotation, the only step that allocates a new image
+    M = cv2.getRotationMatrix2D((w/2, h/2), angle, 1)
+    image = cv2.warpAffine(image, M, (w, h))
+    
+    # Random brightness adjustment, applied in place on the rotated output
+    # (scaling commutes with the linear interpolation of warpAffine)
+    cv2.convertScaleAbs(image, dst=image, alpha=brightness, beta=0)
+    
+    # Random noise, generated into a reused float32 buffer so negative
+    # values stay signed, then added with saturation into the rotated image
+    if noise_buf is None or noise_buf.shape != image.shape:
+        noise_buf = np.empty(image.shape, dtype=np.float32)
+    rng.standard_normal(dtype=np.float32, out=noise_buf)
+    noise_buf *= 25
+    noise_buf += image
+    np.clip(noise_buf, 0, 255, out=noise_buf)
+    np.copyto(image, noise_buf, casting='unsafe')
+    
+    return image, noise_buf
+
+def _labels_dir_for(images_dir):
+    """Map an images directory to its labels directory the way Ultralytics does"""
+    parts = list(Path(images_dir).parts)
+    if 'images' not in parts:
+        raise ValueError(f"Cannot derive a labels directory for {images_dir}, pass output_label_dir")
+    
+    # Ultralytics replaces the last 'images' path component with 'labels'
+    index = len(parts) - 1 - parts[::-1].index('images')
+    parts[index] = 'labels'
+    return Path(*parts)
+
+def _augment_one(img_path, out_dir, num_augmentations, seed, label_dir=None, out_label_dir=None):
+    """Write the original and augmented copies of a single image and its labels"""
+    img = _read_jpeg(img_path)
+    if img is None:
+        return
+    
+    rng = np.random.default_rng(seed)
+    noise_buf = None
+    output_path = Path(out_dir)
+    
+    # Small rotations, brightness and noise keep boxes roughly in place,
+    # so every copy reuses the original label file
+    base_name = Path(img_path).stem
+    label_file = Path(label_dir) / f"{base_name}.txt" if label_dir else None
+    if label_file is not None and not label_file.exists():
+        label_file = None
+    
+    def save(name, image):
+        _write_jpeg(output_path / f"{name}.jpg", image)
+        if label_file is not None:
+            shutil.copyfile(label_file, Path(out_label_dir) / f"{name}.txt")
+    
+    # Original image
+    save(f"{base_name}_orig", img)
+    
+    # Apply augmentations
+    for i in range(num_augmentations):
+        augmented, noise_buf = _augment(img, rng, noise_buf)
+        save(f"{base_name}_aug_{i}", augmented)
 
 class DatasetPreparer:
+    # Dataset directories whose structure was already created in this process
+    _created_dirs = set()
+    
     def __init__(self):
         self.dataset_dir = Path('dataset')
         self.images_dir = self.dataset_dir / 'images'
         self.labels_dir = self.dataset_dir / 'labels'
         
-        # Create directory structure
-        for split in ['train', 'val', 'test']:
-            (self.images_dir / split).mkdir(parents=True, exist_ok=True)
-            (self.labels_dir / split).mkdir(parents=True, exist_ok=True)
+        # Random generator and reusable noise buffer for augmentation
+        self._rng = np.random.default_rng()
+        self._noise_buf = None
+        
+        # Create directory structure, once per dataset directory per process
+        dataset_key = os.path.abspath(self.dataset_dir)
+        if dataset_key not in DatasetPreparer._created_dirs:
+            for split in ['train', 'val', 'test']:
+                (self.images_dir / split).mkdir(parents=True, exist_ok=True)
+                (self.labels_dir / split).mkdir(parents=True, exist_ok=True)
+            DatasetPreparer._created_dirs.add(dataset_key)
     
     def download_sample_images(self):
         """Download sample traffic light images for demonstration"""
@@ -27,23 +214,44 @@ class DatasetPreparer:
         ]
         
         print("Downloading sample images...")
-        for i, url in enumerate(sample_urls):
+        # Downloads are pure network I/O, so fetch them concurrently instead of
+        # paying each request's latency one after another
+        with ThreadPoolExecutor(max_workers=min(16, len(sample_urls))) as executor:
+            downloaded = list(executor.map(self._download_image, range(len(sample_urls)), sample_urls))
+        
+        # Create dummy annotations for the images that were downloaded
+        for filename in downloaded:
+            if filename:
+                self.create_dummy_annotation(filename)
+    
+    def _download_image(self, index, url):
+        """Download a single sample image, returning its filename or None on failure"""
+        try:
+            response = _HTTP.request('GET', url, preload_content=False, timeout=10.0)
             try:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    filename = f"sample_{i+1}.jpg"
+                if response.status == 200:
+                    filename = f"sample_{index+1}.jpg"
                     filepath = self.images_dir / 'train' / filename
                     
-                    with open(filepath, 'wb') as f:
-                        f.write(response.content)
+                    # Stream the body to a temporary file instead of buffering it in
+                    # memory, and only move it into place once it is complete
+                    tmp_path = filepath.with_name(filename + '.part')
+                    try:
+                        with open(tmp_path, 'wb') as f:
+                            shutil.copyfileobj(response, f, length=65536)
+                        os.replace(tmp_path, filepath)
+                    finally:
+                        if tmp_path.exists():
+                            tmp_path.unlink()
                     
                     print(f"Downloaded: {filename}")
-                    
-                    # Create dummy annotation
-                    self.create_dummy_annotation(filename)
-                    
-            except Exception as e:
-                print(f"Failed to download image {i+1}: {e}")
+                    return filename
+            finally:
+                response.release_conn()
+                
+        except Exception as e:
+            print(f"Failed to download image {index+1}: {e}")
+        return None
     
     def create_dummy_annotation(self, image_filename):
         """Create dummy YOLO format annotation"""
@@ -58,44 +266,42 @@ class DatasetPreparer:
         with open(label_path, 'w') as f:
             f.write(dummy_annotation)
     
-    def augment_images(self, input_dir, output_dir, num_augmentations=3):
-        """Apply data augmentation to increase dataset size"""
+    def augment_images(self, input_dir, output_dir, num_augmentations=20, seed=None,
+                       label_dir=None, output_label_dir=None):
+        """Apply data augmentation to increase dataset size
+        
+        Augmentations are precomputed to disk once, together with copies of the
+        matching label files when label_dir is given, so training can run with
+        the per-epoch augmentation disabled (see TrafficLightTrainer.train_model).
+        Labels go to output_label_dir, which defaults to the labels directory
+        that Ultralytics pairs with output_dir (images/... -> labels/...).
+        """
         input_path = Path(input_dir)
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
         
-        for img_file in input_path.glob('*.jpg'):
-            img = cv2.imread(str(img_file))
-            if img is None:
-                continue
-            
-            # Original image
-            base_name = img_file.stem
-            cv2.imwrite(str(output_path / f"{base_name}_orig.jpg"), img)
-            
-            # Apply augmentations
-            for i in range(num_augmentations):
-                augmented = self.apply_augmentation(img)
-                cv2.imwrite(str(output_path / f"{base_name}_aug_{i}.jpg"), augmented)
-    
-    def apply_augmentation(self, image):
-        """Apply random augmentation to image"""
-        h, w = image.shape[:2]
+        if label_dir is not None:
+            if output_label_dir is None:
+                output_label_dir = _labels_dir_for(output_path)
+            output_label_dir = Path(output_label_dir)
+            output_label_dir.mkdir(parents=True, exist_ok=True)
+            label_dir, output_label_dir = str(label_dir), str(output_label_dir)
         
-        # Random brightness adjustment
-        brightness = random.uniform(0.7, 1.3)
-        image = cv2.convertScaleAbs(image, alpha=brightness, beta=0)
+        image_paths = [str(img_file) for img_file in input_path.glob('*.jpg')]
         
-        # Random rotation
-        angle = random.uniform(-10, 10)
-        M = cv2.getRotationMatrix2D((w/2, h/2), angle, 1)
-        image = cv2.warpAffine(image, M, (w, h))
+        # Independent seeds per image keep augmentations reproducible across workers
+        seeds = np.random.SeedSequence(seed).spawn(len(image_paths))
         
-        # Random noise
-        noise = np.random.normal(0, 25, image.shape).astype(np.uint8)
-        image = cv2.add(image, noise)
-        
-        return image
+        # Decode, augment and encode are CPU bound and independent per image
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(_augment_one, image_paths, repeat(str(output_path)),
+                              repeat(num_augmentations), seeds, repeat(label_dir),
+                              repeat(output_label_dir), chunksize=8))
+    
+    def apply_augmentation(self, image):
+        """Apply random augmentation to image"""
+        augmented, self._noise_buf = _augment(image, self._rng, self._noise_buf)
+        return augmented
     
     def split_dataset(self, train_ratio=0.7, val_ratio=0.2, test_ratio=0.1):
         """Split dataset into train/val/test sets"""
@@ -107,39 +313,22 @@ class DatasetPreparer:
     
     def validate_annotations(self):
         """Validate YOLO format annotations"""
-        issues = []
+        label_paths = []
+        image_dirs = []
         
         for split in ['train', 'val', 'test']:
             label_dir = self.labels_dir / split
             image_dir = self.images_dir / split
             
             for label_file in label_dir.glob('*.txt'):
-                # Check if corresponding image exists
-                img_name = label_file.stem + '.jpg'
-                if not (image_dir / img_name).exists():
-                    img_name = label_file.stem + '.png'
-                    if not (image_dir / img_name).exists():
-                        issues.append(f"Missing image for {label_file}")
-                        continue
-                
-                # Validate annotation format
-                try:
-                    with open(label_file, 'r') as f:
-                        lines = f.readlines()
-                    
-                    for line_num, line in enumerate(lines, 1):
-                        parts = line.strip().split()
-                        if len(parts) != 5:
-                            issues.append(f"{label_file}:{line_num} - Invalid format")
-                            continue
-                        
-                        # Check if values are in valid range
-                        class_id, cx, cy, w, h = map(float, parts)
-                        if not (0 <= cx <= 1 and 0 <= cy <= 1 and 0 <= w <= 1 and 0 <= h <= 1):
-                            issues.append(f"{label_file}:{line_num} - Values out of range")
-                
-                except Exception as e:
-                    issues.append(f"{label_file} - Error reading file: {e}")
+                label_paths.append(str(label_file))
+                image_dirs.append(str(image_dir))
+        
+        # Label files are independent, so check them across all cores
+        issues = []
+        with ProcessPoolExecutor() as executor:
+            for file_issues in executor.map(_validate_one, label_paths, image_dirs, chunksize=64):
+                issues.extend(file_issues)
         
         if issues:
             print("Annotation issues found:")
@@ -1,13 +1,175 @@
 import cv2
 import numpy as np
+import torch
 from ultralytics import YOLO
 import os
 from pathlib import Path
 import json
+import queue
+import threading
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, classification falls back to OpenCV
+    njit = None
+
+# Keywords identifying traffic light related model classes
+_TRAFFIC_LIGHT_KEYWORDS = ('light', 'traffic', 'signal')
+
+_FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Minimum number of colored pixels needed to classify a light state
+_MIN_COLOR_PIXELS = 10
+
+# Color ranges in HSV used to classify traffic light states
+_RED_LOWER1 = np.array([0, 50, 50], dtype=np.uint8)
+_RED_UPPER1 = np.array([10, 255, 255], dtype=np.uint8)
+_RED_LOWER2 = np.array([170, 50, 50], dtype=np.uint8)
+_RED_UPPER2 = np.array([180, 255, 255], dtype=np.uint8)
+
+_YELLOW_LOWER = np.array([20, 50, 50], dtype=np.uint8)
+_YELLOW_UPPER = np.array([30, 255, 255], dtype=np.uint8)
+
+_GREEN_LOWER = np.array([40, 50, 50], dtype=np.uint8)
+_GREEN_UPPER = np.array([80, 255, 255], dtype=np.uint8)
+
+# Fixed-point division tables of cv2.cvtColor(COLOR_BGR2HSV) for 8-bit images,
+# so the numba kernel rounds exactly like OpenCV
+_HSV_SHIFT = 12
+_SDIV_TABLE = np.array([0] + [round((255 << _HSV_SHIFT) / v) for v in range(1, 256)], dtype=np.int32)
+_HDIV_TABLE = np.array([0] + [round((180 << _HSV_SHIFT) / (6 * d)) for d in range(1, 256)], dtype=np.int32)
+
+if njit is not None:
+    @njit(cache=True)
+    def _count_light_colors(roi):
+        """Count red/yellow/green pixels of a BGR ROI in a single fused pass
+        
+        Mirrors cv2.cvtColor(COLOR_BGR2HSV) for 8-bit images followed by the
+        inRange checks against the module-level HSV bounds.
+        """
+        red_pixels = 0
+        yellow_pixels = 0
+        green_pixels = 0
+        height, width = roi.shape[0], roi.shape[1]
+        for i in range(height):
+            for j in range(width):
+                b = np.int32(roi[i, j, 0])
+                g = np.int32(roi[i, j, 1])
+                r = np.int32(roi[i, j, 2])
+                
+                # Value and saturation must both reach 50 for every color range
+                v = max(b, g, r)
+                if v < 50:
+                    continue
+                diff = v - min(b, g, r)
+                s = (diff * _SDIV_TABLE[v] + (1 << (_HSV_SHIFT - 1))) >> _HSV_SHIFT
+                if s < 50:
+                    continue
+                
+                # Hue in OpenCV's [0, 180) range, with the same fixed-point rounding
+                if v == r:
+                    h = g - b
+                elif v == g:
+                    h = b - r + 2 * diff
+                else:
+                    h = r - g + 4 * diff
+                h = (h * _HDIV_TABLE[diff] + (1 << (_HSV_SHIFT - 1))) >> _HSV_SHIFT
+                if h < 0:
+                    h += 180
+                
+                if h <= 10 or h >= 170:
+                    red_pixels += 1
+                elif 20 <= h <= 30:
+                    yellow_pixels += 1
+                elif 40 <= h <= 80:
+                    green_pixels += 1
+        
+        return red_pixels, yellow_pixels, green_pixels
+else:
+    _count_light_colors = None
+
+def _count_light_colors_torch(image, boxes, device):
+    """Count red/yellow/green pixels inside each box with torch on the given device
+    
+    Uses the same fixed-point HSV math as _count_light_colors, on the union
+    rectangle of the boxes only. Returns one (red, yellow, green) list per box.
+    """
+    height, width = image.shape[:2]
+    box_array = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    box_array[:, [0, 2]] = box_array[:, [0, 2]].clip(0, width)
+    box_array[:, [1, 3]] = box_array[:, [1, 3]].clip(0, height)
+    left, top = int(box_array[:, 0].min()), int(box_array[:, 1].min())
+    right, bottom = int(box_array[:, 2].max()), int(box_array[:, 3].max())
+    if right <= left or bottom <= top:
+        return [[0, 0, 0] for _ in range(len(box_array))]
+    
+    crop = np.ascontiguousarray(image[top:bottom, left:right])
+    frame = torch.from_numpy(crop).to(device, non_blocking=True).to(torch.int32)
+    b, g, r = frame.unbind(-1)
+    
+    # BGR to HSV with OpenCV's 8-bit fixed-point rounding (H in [0, 180))
+    v = frame.amax(dim=-1)
+    diff = v - frame.amin(dim=-1)
+    sdiv = torch.from_numpy(_SDIV_TABLE).to(device)
+    hdiv = torch.from_numpy(_HDIV_TABLE).to(device)
+    half = 1 << (_HSV_SHIFT - 1)
+    s = (diff * sdiv[v.long()] + half) >> _HSV_SHIFT
+    h = torch.where(v == r, g - b, torch.where(v == g, b - r + 2 * diff, r - g + 4 * diff))
+    h = (h * hdiv[diff.long()] + half) >> _HSV_SHIFT
+    h = torch.where(h < 0, h + 180, h)
+    
+    # Masks for the same HSV ranges as classify_traffic_light_state
+    sv_ok = (s >= 50) & (v >= 50)
+    masks = torch.stack([
+        ((h <= 10) | (h >= 170)) & sv_ok,
+        (h >= 20) & (h <= 30) & sv_ok,
+        (h >= 40) & (h <= 80) & sv_ok,
+    ])
+    
+    # Integral images give every box's pixel counts with four lookups
+    integral = masks.cumsum(1, dtype=torch.int32).cumsum(2, dtype=torch.int32)
+    integral = torch.nn.functional.pad(integral, (1, 0, 1, 0))
+    box_tensor = torch.from_numpy(box_array).to(device)
+    x1 = (box_tensor[:, 0] - left).clamp(0, right - left)
+    y1 = (box_tensor[:, 1] - top).clamp(0, bottom - top)
+    x2 = (box_tensor[:, 2] - left).clamp(0, right - left)
+    y2 = (box_tensor[:, 3] - top).clamp(0, bottom - top)
+    counts = (integral[:, y2, x2] - integral[:, y1, x2]
+              - integral[:, y2, x1] + integral[:, y1, x1])
+    return counts.T.cpu().tolist()
+
+def _read_batches(cap, batch_queue, batch_size, stop_event):
+    """Read frames from a capture into batches on the queue, then a None sentinel
+    
+    Stops early once stop_event is set.
+    """
+    batch = []
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        batch.append(frame)
+        if len(batch) == batch_size:
+            batch_queue.put(batch)
+            batch = []
+    
+    if batch:
+        batch_queue.put(batch)
+    batch_queue.put(None)
+
+def _write_frames(out, write_queue):
+    """Write frames from the queue to a video writer until a None sentinel"""
+    while (frame := write_queue.get()) is not None:
+        out.write(frame)
 
 class TrafficLightDetector:
-    def __init__(self, model_path="models/traffic_light_yolov8.pt"):
-        """Initialize the traffic light detector with YOLOv8 model"""
+    def __init__(self, model_path="models/traffic_light_yolov8.pt", export_onnx=False):
+        """Initialize the traffic light detector with YOLOv8 model
+        
+        With export_onnx=True, CPU-only machines run the model through ONNX Runtime.
+        The first construction then exports the weights to ONNX, which takes a while
+        and lets Ultralytics pip-install missing export packages (e.g. onnxslim).
+        """
         self.model_path = model_path
         self.model = None
         self.class_names = ['red_light', 'yellow_light', 'green_light', 'traffic_light']
@@ -17,13 +179,19 @@ class TrafficLightDetector:
             'green_light': (0, 255, 0),
             'traffic_light': (255, 0, 0)
         }
+        self.use_cuda = torch.cuda.is_available()
+        # FP16 inference on GPU; on CPU the model can optionally run through ONNX Runtime
+        self.half = self.use_cuda
+        self.export_onnx = export_onnx
         self.load_model()
     
     def load_model(self):
         """Load the YOLOv8 model"""
+        weights = 'yolov8n.pt'
         try:
             if os.path.exists(self.model_path):
                 self.model = YOLO(self.model_path)
+                weights = self.model_path
                 print(f"Custom model loaded from {self.model_path}")
             else:
                 # Use pre-trained YOLOv8 model and fine-tune for traffic lights
@@ -32,9 +200,36 @@ class TrafficLightDetector:
         except Exception as e:
             print(f"Error loading model: {e}")
             self.model = YOLO('yolov8n.pt')
+        
+        if self.export_onnx and not self.use_cuda:
+            self.load_onnx_model(weights)
+        
+        # Class ids of traffic light related classes, resolved once per model
+        self._allowed_ids = frozenset(
+            class_id for class_id, class_name in self.model.names.items()
+            if any(keyword in class_name.lower() for keyword in _TRAFFIC_LIGHT_KEYWORDS)
+        )
+    
+    def load_onnx_model(self, weights):
+        """Replace the PyTorch model with an ONNX Runtime export for CPU inference
+        
+        The export runs once per set of weights; Ultralytics checks its export
+        requirements first and may install missing packages over the network.
+        """
+        onnx_path = Path(weights).with_suffix('.onnx')
+        try:
+            # Export once, and again whenever the PyTorch weights are newer
+            if not onnx_path.exists() or (os.path.exists(weights) and
+                                          os.path.getmtime(weights) > os.path.getmtime(onnx_path)):
+                # Dynamic axes so detect_video can run batches of frames
+                onnx_path = Path(self.model.export(format='onnx', imgsz=640, dynamic=True))
+            self.model = YOLO(str(onnx_path), task='detect')
+            print(f"ONNX model loaded from {onnx_path}")
+        except Exception as e:
+            print(f"Error exporting ONNX model, using PyTorch weights: {e}")
     
-    def detect_image(self, image_path, output_path=None, confidence=0.5):
-        """Detect traffic lights in an image"""
+    def detect_image(self, image_path, output_path=None, confidence=0.5, annotate=True):
+        """Detect traffic lights in an image, drawing them unless annotate is False"""
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"Image not found: {image_path}")
         
@@ -44,90 +239,118 @@ class TrafficLightDetector:
             raise ValueError(f"Could not read image: {image_path}")
         
         # Run detection
-        results = self.model(image, conf=confidence)
+        results = self.model(image, conf=confidence, half=self.half)
         
-        # Process results
+        # Process results, drawing straight onto the image since only the
+        # annotated version is returned
         detections = []
-        annotated_image = image.copy()
+        annotated_image = image if annotate else None
         
         for result in results:
-            boxes = result.boxes
-            if boxes is not None:
-                for box in boxes:
-                    # Get box coordinates
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    confidence_score = box.conf[0].cpu().numpy()
-                    class_id = int(box.cls[0].cpu().numpy())
-                    
-                    # Get class name
-                    class_name = self.model.names[class_id] if class_id < len(self.model.names) else 'unknown'
-                    
-                    # Filter for traffic light related classes
-                    if any(keyword in class_name.lower() for keyword in ['light', 'traffic', 'signal']):
-                        # Determine traffic light state based on position and color
-                        roi = image[int(y1):int(y2), int(x1):int(x2)]
-                        light_state = self.classify_traffic_light_state(roi)
-                        
-                        detection = {
-                            'bbox': [int(x1), int(y1), int(x2), int(y2)],
-                            'confidence': float(confidence_score),
-                            'class': class_name,
-                            'light_state': light_state
-                        }
-                        detections.append(detection)
-                        
-                        # Draw bounding box
-                        color = self.colors.get(light_state, (255, 255, 255))
-                        cv2.rectangle(annotated_image, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-                        
-                        # Draw label
-                        label = f"{light_state}: {confidence_score:.2f}"
-                        cv2.putText(annotated_image, label, (int(x1), int(y1) - 10),
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+            detections.extend(self.annotate_frame(image, result, annotated_image))
         
         # Save annotated image
         if output_path:
-            cv2.imwrite(output_path, annotated_image)
+            cv2.imwrite(output_path, image)
+        
+        return detections, image
+    
+    def annotate_frame(self, frame, result, annotated_frame=None, frame_index=None):
+        """Extract traffic light detections from a YOLO result and draw them on annotated_frame if given"""
+        detections = []
+        boxes = result.boxes
+        if boxes is None:
+            return detections
+        
+        # Copy all boxes to the CPU at once instead of syncing per box
+        xyxy = boxes.xyxy.cpu().numpy().astype(np.int32)
+        confidence_scores = boxes.conf.cpu().numpy()
+        class_ids = boxes.cls.cpu().numpy().astype(np.int32)
+        
+        # Collect the traffic light boxes first so their states can be classified in one batch
+        kept = []
+        for (x1, y1, x2, y2), confidence_score, class_id in zip(xyxy, confidence_scores, class_ids):
+            # Filter for traffic light related classes
+            class_id = int(class_id)
+            if class_id in self._allowed_ids:
+                class_name = self.model.names[class_id]
+                kept.append(((int(x1), int(y1), int(x2), int(y2)), confidence_score, class_name))
+        
+        # Determine traffic light state based on position and color
+        light_states = self.classify_traffic_light_states(frame, [bbox for bbox, _, _ in kept])
         
-        return detections, annotated_image
+        for (bbox, confidence_score, class_name), light_state in zip(kept, light_states):
+            x1, y1, x2, y2 = bbox
+            detection = {} if frame_index is None else {'frame': frame_index}
+            detection.update({
+                'bbox': [x1, y1, x2, y2],
+                'confidence': float(confidence_score),
+                'class': class_name,
+                'light_state': light_state
+            })
+            detections.append(detection)
+        
+        if annotated_frame is not None:
+            self.draw_detections(annotated_frame, detections)
+        
+        return detections
+    
+    def draw_detections(self, annotated_frame, detections):
+        """Draw detection boxes and labels onto a frame"""
+        boxes_by_color = {}
+        for detection in detections:
+            color = self.colors.get(detection['light_state'], (255, 255, 255))
+            boxes_by_color.setdefault(color, []).append(detection['bbox'])
+        
+        # Draw bounding boxes with one polylines call per color
+        for color, color_boxes in boxes_by_color.items():
+            xyxy = np.array(color_boxes, dtype=np.int32)
+            corners = np.stack([xyxy[:, [0, 1]], xyxy[:, [2, 1]], xyxy[:, [2, 3]], xyxy[:, [0, 3]]], axis=1)
+            cv2.polylines(annotated_frame, list(corners), True, color, 2)
+        
+        # Draw labels
+        for detection in detections:
+            x1, y1 = detection['bbox'][:2]
+            color = self.colors.get(detection['light_state'], (255, 255, 255))
+            label = f"{detection['light_state']}: {detection['confidence']:.2f}"
+            cv2.putText(annotated_frame, label, (x1, y1 - 10), _FONT, 0.5, color, 2)
     
     def classify_traffic_light_state(self, roi):
         """Classify traffic light state based on color analysis"""
         if roi.size == 0:
             return 'unknown'
         
-        # Convert to HSV for better color detection
-        hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
-        
-        # Define color ranges in HSV
-        red_lower1 = np.array([0, 50, 50])
-        red_upper1 = np.array([10, 255, 255])
-        red_lower2 = np.array([170, 50, 50])
-        red_upper2 = np.array([180, 255, 255])
+        # ROIs smaller than the pixel threshold can never pass it, so skip the color analysis
+        if roi.shape[0] * roi.shape[1] < _MIN_COLOR_PIXELS:
+            return 'traffic_light'
         
-        yellow_lower = np.array([20, 50, 50])
-        yellow_upper = np.array([30, 255, 255])
+        # With numba, HSV conversion and the three color counts run as one jitted pass
+        if _count_light_colors is not None:
+            return self._state_from_counts(*_count_light_colors(roi))
         
-        green_lower = np.array([40, 50, 50])
-        green_upper = np.array([80, 255, 255])
+        # Convert to HSV for better color detection
+        hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
         
-        # Create masks
-        red_mask1 = cv2.inRange(hsv, red_lower1, red_upper1)
-        red_mask2 = cv2.inRange(hsv, red_lower2, red_upper2)
-        red_mask = red_mask1 + red_mask2
+        # Create masks, merging both red hue ranges into the first mask
+        red_mask = cv2.inRange(hsv, _RED_LOWER1, _RED_UPPER1)
+        cv2.bitwise_or(red_mask, cv2.inRange(hsv, _RED_LOWER2, _RED_UPPER2), dst=red_mask)
         
-        yellow_mask = cv2.inRange(hsv, yellow_lower, yellow_upper)
-        green_mask = cv2.inRange(hsv, green_lower, green_upper)
+        yellow_mask = cv2.inRange(hsv, _YELLOW_LOWER, _YELLOW_UPPER)
+        green_mask = cv2.inRange(hsv, _GREEN_LOWER, _GREEN_UPPER)
         
         # Count pixels
         red_pixels = cv2.countNonZero(red_mask)
         yellow_pixels = cv2.countNonZero(yellow_mask)
         green_pixels = cv2.countNonZero(green_mask)
         
+        return self._state_from_counts(red_pixels, yellow_pixels, green_pixels)
+    
+    def _state_from_counts(self, red_pixels, yellow_pixels, green_pixels):
+        """Pick the traffic light state from red/yellow/green pixel counts"""
         # Determine dominant color
         max_pixels = max(red_pixels, yellow_pixels, green_pixels)
         
-        if max_pixels < 10:  # Threshold for minimum pixels
+        if max_pixels < _MIN_COLOR_PIXELS:
             return 'traffic_light'
         
         if red_pixels == max_pixels:
@@ -139,8 +362,39 @@ class TrafficLightDetector:
         else:
             return 'traffic_light'
     
-    def detect_video(self, video_path, output_path=None, confidence=0.5):
-        """Detect traffic lights in a video"""
+    def classify_traffic_light_states(self, image, boxes):
+        """Classify the state of every box in an image
+        
+        On CUDA the color masks are computed once for the area covering all
+        boxes and counted per box from integral images, so all boxes are classified
+        in one batch; otherwise each ROI goes through classify_traffic_light_state.
+        """
+        if len(boxes) == 0:
+            return []
+        
+        if not self.use_cuda:
+            return [self.classify_traffic_light_state(image[y1:y2, x1:x2])
+                    for x1, y1, x2, y2 in boxes]
+        
+        counts = _count_light_colors_torch(image, boxes, 'cuda')
+        states = []
+        for (x1, y1, x2, y2), (red_pixels, yellow_pixels, green_pixels) in zip(boxes, counts):
+            if x2 <= x1 or y2 <= y1:
+                states.append('unknown')
+            else:
+                states.append(self._state_from_counts(red_pixels, yellow_pixels, green_pixels))
+        return states
+    
+    def detect_video(self, video_path, output_path=None, confidence=0.5, batch_size=16, stride=2):
+        """Detect traffic lights in a video, running inference on batches of frames
+        
+        Only every stride-th frame goes through the model; the frames in between
+        reuse the previous detections. Use stride=1 to run detection on every frame.
+        Each model call gets batch_size frames.
+        """
+        if stride < 1:
+            raise ValueError(f"stride must be at least 1, got {stride}")
+        
         if not os.path.exists(video_path):
             raise FileNotFoundError(f"Video not found: {video_path}")
         
@@ -162,67 +416,78 @@ class TrafficLightDetector:
         
         frame_detections = []
         frame_count = 0
+        detections = []
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Run detection on frame
-            results = self.model(frame, conf=confidence)
-            
-            # Process results
-            detections = []
-            annotated_frame = frame.copy()
-            
-            for result in results:
-                boxes = result.boxes
-                if boxes is not None:
-                    for box in boxes:
-                        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                        confidence_score = box.conf[0].cpu().numpy()
-                        class_id = int(box.cls[0].cpu().numpy())
-                        
-                        class_name = self.model.names[class_id] if class_id < len(self.model.names) else 'unknown'
-                        
-                        if any(keyword in class_name.lower() for keyword in ['light', 'traffic', 'signal']):
-                            roi = frame[int(y1):int(y2), int(x1):int(x2)]
-                            light_state = self.classify_traffic_light_state(roi)
-                            
-                            detection = {
-                                'frame': frame_count,
-                                'bbox': [int(x1), int(y1), int(x2), int(y2)],
-                                'confidence': float(confidence_score),
-                                'class': class_name,
-                                'light_state': light_state
-                            }
-                            detections.append(detection)
-                            
-                            # Draw bounding box
-                            color = self.colors.get(light_state, (255, 255, 255))
-                            cv2.rectangle(annotated_frame, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-                            
-                            # Draw label
-                            label = f"{light_state}: {confidence_score:.2f}"
-                            cv2.putText(annotated_frame, label, (int(x1), int(y1) - 10),
-                                      cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-            
-            frame_detections.append(detections)
-            
-            # Write frame to output video
-            if out:
-                out.write(annotated_frame)
-            
-            frame_count += 1
-            
-            # Display progress
-            if frame_count % 30 == 0:
-                print(f"Processed {frame_count} frames")
+        # Decode frames on a background thread so it overlaps with inference. Each
+        # batch holds batch_size * stride frames so batch_size of them are inferred,
+        # and the queue is shortened to keep about as many frames in memory
+        read_size = batch_size * stride
+        batch_queue = queue.Queue(maxsize=max(1, 4 // stride))
+        stop_reading = threading.Event()
+        reader = threading.Thread(target=_read_batches, args=(cap, batch_queue, read_size, stop_reading),
+                                  daemon=True)
+        reader.start()
         
-        # Release resources
-        cap.release()
+        # Encode output frames on a background thread so it overlaps with inference
+        write_queue = None
         if out:
-            out.release()
+            write_queue = queue.Queue(maxsize=8)
+            writer = threading.Thread(target=_write_frames, args=(out, write_queue), daemon=True)
+            writer.start()
+        
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is None:
+                    break
+                
+                # Run detection once per batch, on every stride-th frame only; batches
+                # start on a stride boundary, so this is batch_size frames
+                infer_frames = [batch_frame for i, batch_frame in enumerate(batch)
+                                if (frame_count + i) % stride == 0]
+                results = iter(self.model(infer_frames, conf=confidence, half=self.half) if infer_frames else [])
+                
+                # Process results in frame order so the output video stays in sequence
+                for batch_frame in batch:
+                    # Frames are not reused after this, so draw on them in place and
+                    # only when they are written to the output video
+                    annotated_frame = batch_frame if write_queue else None
+                    if frame_count % stride == 0:
+                        detections = self.annotate_frame(batch_frame, next(results), annotated_frame, frame_count)
+                    else:
+                        # Traffic scenes change slowly, so reuse the last detections
+                        detections = [dict(detection, frame=frame_count) for detection in detections]
+                        if annotated_frame is not None:
+                            self.draw_detections(annotated_frame, detections)
+                    frame_detections.append(detections)
+                    
+                    # Write frame to output video
+                    if write_queue:
+                        write_queue.put(annotated_frame)
+                    
+                    frame_count += 1
+                    
+                    # Display progress
+                    if frame_count % 30 == 0:
+                        print(f"Processed {frame_count} frames")
+        
+        finally:
+            # Stop the reader, draining the queue in case it is blocked on a full queue
+            stop_reading.set()
+            while reader.is_alive():
+                try:
+                    batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader.join()
+            cap.release()
+            
+            # Release the writer once every queued frame has been written, so
+            # the output video is finalized even when detection fails
+            if out:
+                write_queue.put(None)
+                writer.join()
+                out.release()
         
         return frame_detections
 
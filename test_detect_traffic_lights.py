@@ -0,0 +1,85 @@
+import importlib
+import sys
+import types
+from unittest import mock
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('numba')
+
+def _stub_missing(*names):
+    """Placeholder modules for heavy dependencies the color kernels don't use"""
+    stubs = {}
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            stubs[name] = types.ModuleType(name)
+    if 'ultralytics' in stubs:
+        stubs['ultralytics'].YOLO = None
+    return stubs
+
+# torch and ultralytics are only needed to run the model, so import the
+# detector module with stand-ins when they are not installed
+_STUBS = _stub_missing('torch', 'ultralytics')
+with mock.patch.dict(sys.modules, _STUBS):
+    import detect_traffic_lights as dtl
+
+# Keep the module registered, numba's on-disk cache looks it up by name
+sys.modules.setdefault('detect_traffic_lights', dtl)
+
+def opencv_color_counts(roi):
+    """Red/yellow/green pixel counts using the cvtColor + inRange path"""
+    hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
+    red_mask = cv2.inRange(hsv, dtl._RED_LOWER1, dtl._RED_UPPER1)
+    cv2.bitwise_or(red_mask, cv2.inRange(hsv, dtl._RED_LOWER2, dtl._RED_UPPER2), dst=red_mask)
+    yellow_mask = cv2.inRange(hsv, dtl._YELLOW_LOWER, dtl._YELLOW_UPPER)
+    green_mask = cv2.inRange(hsv, dtl._GREEN_LOWER, dtl._GREEN_UPPER)
+    return (cv2.countNonZero(red_mask), cv2.countNonZero(yellow_mask), cv2.countNonZero(green_mask))
+
+def test_count_light_colors_matches_opencv_over_bgr_cube():
+    """The numba kernel must agree with OpenCV for every 8-bit BGR color"""
+    cube = np.indices((256, 256, 256), dtype=np.uint8).reshape(3, -1).T.reshape(4096, 4096, 3)
+    cube = np.ascontiguousarray(cube)
+
+    assert dtl._count_light_colors(cube) == opencv_color_counts(cube)
+
+    # Compare row by row too, so per-pixel errors cannot cancel out in the totals
+    for i in range(cube.shape[0]):
+        row = cube[i:i + 1]
+        assert dtl._count_light_colors(row) == opencv_color_counts(row), f"row {i}"
+
+def test_count_light_colors_green_lamp_on_sky():
+    """Hues with a negative numerator (e.g. sky blue) must not be counted as red"""
+    roi = np.full((20, 20, 3), (235, 206, 135), dtype=np.uint8)
+    roi[5:15, 5:15] = (0, 255, 0)
+
+    assert dtl._count_light_colors(roi) == opencv_color_counts(roi) == (0, 0, 100)
+
+def test_count_light_colors_torch_matches_opencv_over_bgr_cube():
+    """The tensor HSV/mask path must agree with OpenCV, run here on CPU tensors"""
+    if 'torch' in _STUBS:
+        pytest.skip('torch is not installed')
+    cube = np.indices((256, 256, 256), dtype=np.uint8).reshape(3, -1).T.reshape(4096, 4096, 3)
+    cube = np.ascontiguousarray(cube)
+
+    # One box per row, so per-pixel errors cannot cancel out in the totals
+    boxes = [[0, i, 4096, i + 1] for i in range(cube.shape[0])]
+    counts = dtl._count_light_colors_torch(cube, boxes, 'cpu')
+    for i, row_counts in enumerate(counts):
+        assert tuple(row_counts) == opencv_color_counts(cube[i:i + 1]), f"row {i}"
+
+def test_count_light_colors_torch_crops_to_union_of_boxes():
+    """Boxes are counted relative to the union crop and clipped to the image"""
+    if 'torch' in _STUBS:
+        pytest.skip('torch is not installed')
+    image = np.zeros((100, 120, 3), dtype=np.uint8)
+    image[20:30, 40:50] = (0, 0, 255)
+    image[60:70, 90:100] = (0, 255, 0)
+    boxes = [[35, 15, 55, 35], [85, 55, 130, 75], [110, 90, 140, 120]]
+
+    counts = dtl._count_light_colors_torch(image, boxes, 'cpu')
+    expected = [opencv_color_counts(image[y1:y2, x1:x2]) for x1, y1, x2, y2 in boxes]
+    assert [tuple(c) for c in counts] == expected == [(100, 0, 0), (0, 0, 100), (0, 0, 0)]
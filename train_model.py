@@ -3,6 +3,19 @@ import os
 import yaml
 from pathlib import Path
 
+# Training overrides that turn off Ultralytics' per-epoch augmentation, for
+# datasets that were already expanded with DatasetPreparer.augment_images
+NO_AUGMENTATION = {
+    'mosaic': 0.0,
+    'mixup': 0.0,
+    'hsv_h': 0.0,
+    'hsv_s': 0.0,
+    'hsv_v': 0.0,
+    'translate': 0.0,
+    'scale': 0.0,
+    'fliplr': 0.0,
+}
+
 class TrafficLightTrainer:
     def __init__(self):
         self.model = None
@@ -55,8 +68,14 @@ class TrafficLightTrainer:
         with open('dataset/annotation_format.txt', 'w') as f:
             f.write(sample_annotation)
     
-    def train_model(self, epochs=100, img_size=640, batch_size=16):
-        """Train the YOLOv8 model"""
+    def train_model(self, epochs=100, img_size=640, batch_size=16, augment=True, cache='ram'):
+        """Train the YOLOv8 model
+        
+        Pass augment=False when the training images were precomputed with
+        DatasetPreparer.augment_images to skip augmenting again every epoch.
+        Decoded images are cached in RAM so JPEGs are decoded once per run;
+        use cache='disk' to keep the decoded arrays as .npy files across runs.
+        """
         if not os.path.exists('dataset/data.yaml'):
             print("Creating dataset configuration...")
             self.create_dataset_config()
@@ -65,17 +84,20 @@ class TrafficLightTrainer:
         self.model = YOLO('yolov8n.pt')  # Start with nano model for faster training
         
         # Train the model
+        augmentation = {} if augment else NO_AUGMENTATION
         try:
             results = self.model.train(
                 data='dataset/data.yaml',
                 epochs=epochs,
                 imgsz=img_size,
                 batch=batch_size,
+                cache=cache,
                 name='traffic_light_detection',
                 project='runs/detect',
                 save=True,
                 plots=True,
-                device='cpu'  # Change to 'cuda' if GPU available
+                device='cpu',  # Change to 'cuda' if GPU available
+                **augmentation
             )
             
             print("Training completed!")